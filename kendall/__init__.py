@@ -1,3 +1,8 @@
-from .main import Entity, Simulator, Stream
+from .main import Entity, Simulator, Stream, VariateStream
 from .streams import Queue, Worker, Splitter, RandomSplitter, Merger, Dropper
 from .spawners import ConstantSpawner, UniformSpawner, ExponentialSpawner
+from .replication import run_replications, compare_scenarios, confidence_interval
+from .splitting import fixed_effort_splitting, blocking_probability
+from .parallel import ParallelSimulator, check_against_sequential
+from .sampler import Sampler
+from .fluid import FluidModel, calibrate
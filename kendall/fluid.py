@@ -0,0 +1,252 @@
+import numpy
+from .main import SingleInputStream, SingleOutputStream
+from .sampler import Sampler, busy_servers
+from .spawners import Spawner
+from .streams import Queue, Worker, Splitter, RandomSplitter
+
+
+class FluidModel(object):
+    """
+    A fluid approximation of a simulator's stream graph.
+
+    Instead of simulating entities, it integrates the average amount of work at every worker.
+    Each worker, together with the queue piped into it, is a station holding n entities.
+    It serves min(n, capacity) / mean_time_to_finish per unit time, and drops whatever arrives
+    while n is at capacity + max_queued. Spawners arrive at 1 / mean_spawn_time, and random
+    splitters divide their flow evenly between destinations. Everything else passes its flow
+    through. Other splitters pick a destination by its state, e.g. the base Splitter sends
+    everything to the first ready destination, so they are not supported. Neither are queues
+    that do not feed a worker directly, e.g. one waiting line shared through a splitter.
+
+    This is accurate when queues are long and servers are many, i.e. heavy traffic.
+    Near the edge of overload it misses the randomness, e.g. a loss system that is
+    not overloaded drops nothing. Use calibrate() to see how far off it is for a model.
+    """
+    def __init__(self, simulator):
+        self.simulator = simulator
+        streams = [stream for stream in simulator.streams.values()
+                   if isinstance(stream, (SingleInputStream, SingleOutputStream))]
+        self.spawners = [stream for stream in streams if isinstance(stream, Spawner)]
+        self.workers = [stream for stream in streams if isinstance(stream, Worker)]
+        self.queues = [worker.source if isinstance(worker.source, Queue) else None
+                       for worker in self.workers]
+        self.names = [worker.name for worker in self.workers]
+        self.index = dict((id(worker), index) for index, worker in enumerate(self.workers))
+
+        self.capacity = numpy.array([worker.capacity for worker in self.workers], dtype=float)
+        self.service_rate = numpy.array([1.0 / _mean_time_to_finish(worker)
+                                         for worker in self.workers])
+        self.limit = self.capacity + numpy.array([queue.max_queued if queue is not None else 0
+                                                  for queue in self.queues], dtype=float)
+        self.spawn_rate = numpy.array([1.0 / spawner.mean_spawn_time()
+                                       for spawner in self.spawners])
+
+        # Fraction of each spawner's and each worker's output that reaches each worker
+        self.spawn_routing = numpy.zeros((len(self.spawners), len(self.workers)))
+        for row, spawner in enumerate(self.spawners):
+            self._route(spawner.destination, 1.0, self.spawn_routing[row], set())
+        self.routing = numpy.zeros((len(self.workers), len(self.workers)))
+        for row, worker in enumerate(self.workers):
+            self._route(worker.destination, 1.0, self.routing[row], set())
+
+    def _route(self, stream, fraction, row, visited):
+        if stream is None:
+            return
+        if isinstance(stream, Worker):
+            row[self.index[id(stream)]] += fraction
+            return
+        if id(stream) in visited:
+            raise Exception("Stream {} is part of a loop without a worker".format(stream.name))
+        visited = visited | set([id(stream)])
+        if isinstance(stream, Queue) and not isinstance(stream.destination, Worker):
+            raise Exception("Queue {} does not feed a worker directly, "
+                            "so the fluid model cannot place its waiting line".format(stream.name))
+        if isinstance(stream, Splitter):
+            if _defining_class(stream, 'select_destination') is not RandomSplitter:
+                raise Exception("Splitter {} does not split evenly at random, "
+                                "so the fluid model cannot route it".format(stream.name))
+            for destination in stream.destinations:
+                self._route(destination, fraction / len(stream.destinations), row, visited)
+        else:
+            self._route(getattr(stream, 'destination', None), fraction, row, visited)
+
+    def solve(self, time_limit=None, interval=1.0, step=None):
+        """
+        Integrates the model from an empty network and returns a FluidTrajectory
+        sampled every interval up to time_limit (defaults to the simulator's).
+        step is the Euler step. It defaults to a twentieth of the shortest mean time to finish.
+    Arrival rates do not limit it, since arrivals only add a constant inflow.
+        """
+        if time_limit is None:
+            time_limit = self.simulator.time_limit
+        if step is None:
+            step = 0.05 / numpy.max(self.service_rate)
+        samples = int(time_limit / interval) + 1
+        trajectory = FluidTrajectory(self.names, numpy.arange(samples) * float(interval))
+
+        n = numpy.zeros(len(self.workers))
+        dropped = numpy.zeros(len(self.workers))
+        spawn_arrivals = self.spawn_rate.dot(self.spawn_routing)
+        time = 0.0
+        sample = 0
+        while sample < samples:
+            served = self.service_rate * numpy.minimum(n, self.capacity)
+            arrivals = spawn_arrivals + served.dot(self.routing)
+            accepted = numpy.where(n >= self.limit, numpy.minimum(arrivals, served), arrivals)
+            while sample < samples and trajectory.times[sample] <= time:
+                trajectory.record(sample, numpy.maximum(n - self.capacity, 0.0),
+                                  numpy.minimum(n, self.capacity), served, arrivals - accepted,
+                                  dropped)
+                sample += 1
+            n = numpy.clip(n + step * (accepted - served), 0.0, self.limit)
+            dropped += step * (arrivals - accepted)
+            time += step
+        return trajectory
+
+
+class FluidTrajectory(object):
+    """
+    The result of FluidModel.solve. Every attribute but times maps a worker's name
+    to an array with one value per sample.
+    queue_length -- Entities waiting in the queue in front of the worker.
+    busy -- Entities being worked on.
+    throughput -- Entities finished per unit time.
+    drop_rate -- Entities dropped per unit time.
+    dropped -- Entities dropped so far.
+    """
+    def __init__(self, names, times):
+        self.names = names
+        self.times = times
+        metrics = ('queue_length', 'busy', 'throughput', 'drop_rate', 'dropped')
+        self.columns = dict((metric, numpy.zeros((len(times), len(names)))) for metric in metrics)
+        self._name_columns()
+
+    def _name_columns(self):
+        for metric, values in self.columns.items():
+            setattr(self, metric, dict((name, values[:, index])
+                                       for index, name in enumerate(self.names)))
+
+    def record(self, sample, queue_length, busy, throughput, drop_rate, dropped):
+        self.columns['queue_length'][sample] = queue_length
+        self.columns['busy'][sample] = busy
+        self.columns['throughput'][sample] = throughput
+        self.columns['drop_rate'][sample] = drop_rate
+        self.columns['dropped'][sample] = dropped
+
+    def scaled(self, factor):
+        """Returns a copy with every value divided by factor"""
+        trajectory = FluidTrajectory(self.names, self.times)
+        for metric, values in self.columns.items():
+            trajectory.columns[metric] = values / float(factor)
+        trajectory._name_columns()
+        return trajectory
+
+
+class FluidCalibration(object):
+    """
+    The result of calibrate.
+    fluid -- The FluidTrajectory of the full model, divided by scale.
+    scale -- The factor the discrete model was scaled down by.
+    discrete -- Maps 'queue_length', 'busy' and 'dropped' to dicts from worker name to
+                the average over replications at each sample.
+    errors -- Maps each worker name to a dict from those metrics to the mean absolute
+              difference between the fluid and discrete values over the samples.
+    """
+    def __init__(self, fluid, discrete, scale=1):
+        self.fluid = fluid
+        self.discrete = discrete
+        self.scale = scale
+        self.errors = {}
+        for name in fluid.names:
+            self.errors[name] = {}
+            for metric, values in discrete.items():
+                fluid_values = getattr(fluid, metric)[name]
+                length = min(len(fluid_values), len(values[name]))
+                difference = numpy.abs(fluid_values[:length] - values[name][:length])
+                self.errors[name][metric] = float(numpy.mean(difference))
+
+
+def calibrate(simulator, replications=10, interval=1.0, seed=0, scale=1):
+    """
+    Compares the fluid approximation of simulator against the discrete engine.
+    A copy of the simulator is run replications times with seeds from seed, sampling every
+    worker every interval, and the averages are compared with FluidModel(simulator).solve().
+
+    A big model can be checked through a copy scaled down by scale, so the discrete runs stay
+    quick: the time between spawns is multiplied by scale, and worker capacities and queue
+    limits are divided by it and rounded. The fluid solution of the full model is divided by
+    scale before comparing. Pick a scale that divides the capacities, or the rounding will
+    show up in the errors.
+    """
+    model = FluidModel(simulator)
+    fluid = model.solve(interval=interval)
+    if scale != 1:
+        fluid = fluid.scaled(scale)
+
+    small = simulator.clone()
+    small_model = FluidModel(small)
+    if scale != 1:
+        _scale_down(small_model, scale)
+
+    gauges = []
+    for worker, queue in zip(small_model.workers, small_model.queues):
+        gauges.append((worker.name + ' queue_length', worker, _waiting(queue)))
+        gauges.append((worker.name + ' busy', worker, busy_servers))
+        gauges.append((worker.name + ' dropped', worker, _dropped(queue)))
+    sampler = Sampler(name='Fluid Calibration Sampler', simulator=small, gauges=gauges,
+                      interval=interval, capacity=len(fluid.times))
+
+    totals = {}
+    for replication in xrange(replications):
+        small.seed = seed + replication
+        small.run()
+        samples = sampler.samples()
+        for column, label in enumerate(sampler.labels):
+            values = samples[:, column + 1]
+            if label in totals:
+                length = min(len(values), len(totals[label]))
+                totals[label] = totals[label][:length] + values[:length]
+            else:
+                totals[label] = values
+
+    discrete = {}
+    for metric in ('queue_length', 'busy', 'dropped'):
+        discrete[metric] = dict((name, totals[name + ' ' + metric] / float(replications))
+                                for name in model.names)
+    return FluidCalibration(fluid, discrete, scale)
+
+
+def _scale_down(model, scale):
+    for spawner in model.spawners:
+        spawner.scale_spawn_time(scale)
+    for worker, queue in zip(model.workers, model.queues):
+        worker.capacity = max(1, int(round(worker.capacity / float(scale))))
+        if queue is not None and queue.max_queued < 10**100:
+            queue.max_queued = int(round(queue.max_queued / float(scale)))
+
+
+def _mean_time_to_finish(worker):
+    if worker.mean_time_to_finish is not None:
+        return float(worker.mean_time_to_finish)
+    if _defining_class(worker, 'time_to_finish') is Worker:
+        return 1.0
+    raise Exception("Worker {} overrides time_to_finish, so it needs mean_time_to_finish".format(
+        worker.name))
+
+
+def _defining_class(stream, method):
+    for klass in type(stream).__mro__:
+        if method in vars(klass):
+            return klass
+
+
+def _waiting(queue):
+    def gauge(worker):
+        return len(queue.queue) if queue is not None else 0
+    return gauge
+
+
+def _dropped(queue):
+    def gauge(worker):
+        return worker.dropped + (queue.dropped if queue is not None else 0)
+    return gauge
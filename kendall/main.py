@@ -1,4 +1,18 @@
+import copy
 import heapq
+import math
+import numbers
+import sys
+import zlib
+import numpy.random
+from array import array
+
+# Entity event kinds
+ENTER = 0
+EXIT = 1
+DROP = 2
+EVENT_NAMES = ('enter', 'exit', 'drop')
+EVENT_CODES = {'enter': ENTER, 'exit': EXIT, 'drop': DROP}
 
 
 class Simulator(object):
@@ -6,19 +20,81 @@ class Simulator(object):
     A Simulator is an object that runs simulations.
     It maintains a list of future events, among other things.
     It also contains a list of all entities ever in the simulation.
+
+    Keyword Arguments:
+    time_limit -- Events after this time are not processed.
+    seed -- If set, every stream draws from its own substream seeded from this.
+            Two simulators with the same seed then use common random numbers.
+    antithetic -- If True, substreams produce the antithetic variates of the seed.
+    entity_pool -- If True, entities that are dropped or leave the network are recycled
+                   into new ones. Entities are then not kept in entity_list, since they get reused.
     """
     def __init__(self, *args, **kwargs):
         self.entity_list = []
         self.event_queue = []
         self.streams = {}
+        # Stream names by id. Ids are dense and follow registration order, so ties between
+        # streams of equal priority never depend on other simulators in the process.
+        self.stream_names = []
+        self.stream_ids = {}
+        self.random_streams = {}
         self.current_time = 0
+        self.event_count = 0
         self.time_limit = kwargs.get('time_limit', 0)
+        self.seed = kwargs.get('seed', None)
+        self.antithetic = kwargs.get('antithetic', False)
+        self.entity_pool = {} if kwargs.get('entity_pool', False) else None
 
     def register_stream(self, stream):
+        stream.id = self.stream_ids.get(stream.name)
+        if stream.id is None:
+            stream.id = len(self.stream_names)
+            self.stream_ids[stream.name] = stream.id
+            self.stream_names.append(stream.name)
         self.streams[stream.name] = stream
 
     def add_entity(self, entity):
-        self.entity_list.append(entity)
+        entity.stream_names = self.stream_names
+        entity.stream_ids = self.stream_ids
+        if self.entity_pool is None:
+            self.entity_list.append(entity)
+
+    def reuse_entity(self, entity_class):
+        """
+        Returns a recycled entity of exactly entity_class,
+        or None if pooling is off or none are free.
+        """
+        if self.entity_pool is None:
+            return None
+        free = self.entity_pool.get(entity_class)
+        if not free:
+            return None
+        entity = free.pop()
+        entity.recycle()
+        return entity
+
+    def release_entity(self, entity):
+        """Called by streams when an entity is dropped or leaves the network"""
+        if self.entity_pool is not None:
+            self.entity_pool.setdefault(type(entity), []).append(entity)
+
+    def random_stream(self, key):
+        """
+        Returns the VariateStream for a logical source of randomness.
+        key is either a stream (its name is used) or any other string, e.g. "Attraction A service".
+        Without a seed every key shares the global numpy.random state.
+        """
+        if isinstance(key, Stream):
+            key = key.name
+        variates = self.random_streams.get(key)
+        if variates is None:
+            if self.seed is None:
+                state = numpy.random
+            else:
+                state = numpy.random.RandomState([self.seed, zlib.crc32(str(key)) & 0xffffffff])
+            variates = VariateStream(state, self.antithetic)
+            self.random_streams[key] = variates
+        return variates
 
     def tick_future(self, stream, time):
         event = SimulatorEvent(stream, stream.priority, time)
@@ -26,41 +102,180 @@ class Simulator(object):
 
     def run(self):
         self.reset()
+        self.start()
+        self.advance()
+
+    def start(self):
         for name, stream in self.streams.iteritems():
             stream.start()
-        while len(self.event_queue) > 0:
-            event = heapq.heappop(self.event_queue)
-            if event.time > self.time_limit:
-                break
-            event.stream.tick(event.time)
+
+    def advance(self, until=None, stop=None):
+        """
+        Processes events up to and including time until (defaults to time_limit).
+        If stop is given, it is called with the simulator after every event and
+        advancing halts as soon as it returns True. Returns whether stop halted it.
+        Events later than until stay queued, so a simulation can be advanced further later.
+        """
+        if until is None:
+            until = self.time_limit
+        while len(self.event_queue) > 0 and self.event_queue[0].time <= until:
+            self.dispatch(heapq.heappop(self.event_queue))
+            if stop is not None and stop(self):
+                return True
+        return False
+
+    def dispatch(self, event):
+        self.current_time = event.time
+        self.event_count += 1
+        event.stream.tick(event.time)
+
+    def clone(self):
+        """
+        Returns a deep copy of this simulator mid-run: its streams, queued events, entities
+        and substreams. Advancing the clone leaves this simulator untouched.
+        Seeded clones replay the same draws unless reseeded.
+        """
+        # The global numpy.random state is shared, not copied
+        return copy.deepcopy(self, {id(numpy.random): numpy.random})
+
+    def reseed(self, seed):
+        """Restarts every substream from a new seed, e.g. so a clone diverges from the original"""
+        self.seed = seed
+        self.random_streams.clear()
 
     def reset(self):
         self.current_time = 0
+        self.event_count = 0
         del self.entity_list[:]
         del self.event_queue[:]
+        self.random_streams.clear()
 
 
 class Entity(object):
+    """
+    An entity keeps its history in two arrays:
+    times -- The time of each event.
+    codes -- The stream id and kind of each event, packed as stream.id << 2 | kind,
+             where kind is ENTER, EXIT or DROP.
+
+    event_list, event_table and event_time give the history by stream name for analysis.
+    They look ids up in the stream tables of the simulator the entity was added to,
+    or of Stream.simulator if it was never added to one.
+    """
     id = 1
+    stream_names = None
+    stream_ids = None
+    # (number of events, table) of the last event_table built
+    _event_table = None
 
     def __init__(self):
         self.id = Entity.id
-        self.event_list = []
-        self.event_table = {}
+        self.times = array('d')
+        self.codes = array('l')
+        Entity.id += 1
+
+    def recycle(self):
+        """
+        Called when a pooled entity is handed out again, to make it look freshly created.
+        Subclasses with their own fields should override this, call super, and reset them.
+        """
+        self.id = Entity.id
+        del self.times[:]
+        del self.codes[:]
+        self._event_table = None
         Entity.id += 1
 
     def _on_any_event(self, stream, time, event):
-        self.event_list.append((time, event, stream.name))
-        self.event_table[stream.name, event] = time
+        self.times.append(time)
+        self.codes.append(stream.id << 2 | event)
 
     def on_enter(self, stream, time):
-        self._on_any_event(stream, time, 'enter')
+        self._on_any_event(stream, time, ENTER)
 
     def on_exit(self, stream, time):
-        self._on_any_event(stream, time, 'exit')
+        self._on_any_event(stream, time, EXIT)
 
     def on_drop(self, stream, time):
-        self._on_any_event(stream, time, 'drop')
+        self._on_any_event(stream, time, DROP)
+
+    @property
+    def event_list(self):
+        """A list of (time, event, stream name) in the order they happened"""
+        stream_names = self._stream_tables()[0]
+        return [(time, EVENT_NAMES[code & 3], stream_names[code >> 2])
+                for time, code in zip(self.times, self.codes)]
+
+    @property
+    def event_table(self):
+        """
+        A dict from (stream name, event) to the time it last happened.
+        It is built once and rebuilt only after new events, so lookups in it stay cheap.
+        """
+        if self._event_table is None or self._event_table[0] != len(self.codes):
+            table = {}
+            for time, event, name in self.event_list:
+                table[name, event] = time
+            self._event_table = (len(self.codes), table)
+        return self._event_table[1]
+
+    def event_time(self, name, event):
+        """
+        The time event last happened at the stream with this name, or None.
+        Cheaper than event_table.
+        """
+        stream_id = self._stream_tables()[1].get(name)
+        if stream_id is None:
+            return None
+        code = stream_id << 2 | EVENT_CODES[event]
+        for index in xrange(len(self.codes) - 1, -1, -1):
+            if self.codes[index] == code:
+                return self.times[index]
+        return None
+
+    def _stream_tables(self):
+        if self.stream_names is not None:
+            return self.stream_names, self.stream_ids
+        if Stream.simulator is None:
+            raise Exception("Entity {} was never added to a simulator, "
+                            "so its stream names are unknown".format(self.id))
+        return Stream.simulator.stream_names, Stream.simulator.stream_ids
+
+
+class VariateStream(object):
+    """
+    A VariateStream turns uniforms from one random state into the variates streams need.
+    Every variate uses a fixed number of uniforms, so the same draws line up across scenarios.
+    If antithetic is set, each uniform u is replaced by 1 - u (normals are mirrored instead).
+    """
+    def __init__(self, state, antithetic=False):
+        self.state = state
+        self.antithetic = antithetic
+
+    def random(self):
+        u = self.state.random_sample()
+        if self.antithetic:
+            return 1.0 - u
+        return u
+
+    def uniform(self, low=0.0, high=1.0):
+        return low + (high - low) * self.random()
+
+    def exponential(self, scale=1.0):
+        # random_sample() is in [0, 1), so 1 - u is never zero but its antithetic u can be
+        u = self.state.random_sample()
+        if self.antithetic:
+            return -scale * math.log(max(u, sys.float_info.min))
+        return -scale * math.log(1.0 - u)
+
+    def normal(self, loc=0.0, scale=1.0):
+        z = self.state.standard_normal()
+        if self.antithetic:
+            z = -z
+        return loc + scale * z
+
+    def choice(self, sequence):
+        index = int(self.random() * len(sequence))
+        return sequence[min(index, len(sequence) - 1)]
 
 
 class SimulatorEvent(object):
@@ -78,9 +293,9 @@ class SimulatorEvent(object):
             return -1
         elif self.priority > other.priority:
             return 1
-        elif self.stream.name < other.stream.name:
+        elif self.stream.id < other.stream.id:
             return 1
-        elif self.stream.name > other.stream.name:
+        elif self.stream.id > other.stream.id:
             return -1
         return 0
 
@@ -99,7 +314,9 @@ class Stream(object):
     Streams have two attributes:
     name - The name of the stream used by the simulator. This should be unique.
     priority - The priority of this stream if multiple events with similar timings occur.
-               In case of ties we use stream name.
+               In case of ties we use stream id, and the stream registered last goes first.
+    id - A dense integer for the name, counting from 0 in the order streams are registered
+         with their simulator.
     simulator - The simulator this stream belongs to.
 
     For the lazy, just set Stream.simulator = my_simulator
@@ -147,6 +364,36 @@ class Stream(object):
         """
         pass
 
+    def lookahead(self):
+        """
+        The least time an entity spends in this stream, if known. It must be positive.
+        Links out of streams with a lookahead can be split across processes by ParallelSimulator.
+        Streams that hold entities and give a lookahead should also implement next_output_time.
+        """
+        return None
+
+    def next_output_time(self):
+        """
+        The earliest time an entity already in this stream can leave it, or None if none can.
+        Used with lookahead to tell other partitions how long this stream stays quiet.
+        """
+        return None
+
+    def always_ready(self):
+        """
+        True if this stream accepts every entity and never tells its sources it is unready.
+        Links into such streams can be split across processes by ParallelSimulator.
+        """
+        return False
+
+    def partition_state(self):
+        """
+        The state ParallelSimulator copies back from the process that ran this stream.
+        By default every attribute that is a plain number, like counters such as dropped.
+        """
+        return dict((name, value) for name, value in vars(self).items()
+                    if isinstance(value, numbers.Number))
+
 
 class SingleOutputStream(Stream):
     def __init__(self, *args, **kwargs):
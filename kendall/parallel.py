@@ -0,0 +1,371 @@
+import heapq
+import multiprocessing
+import pickle
+import traceback
+from collections import deque
+import numpy
+from Queue import Empty
+from .main import Entity, SimulatorEvent, Stream
+
+
+class ParallelSimulator(object):
+    """
+    Runs the streams of one simulator across several processes.
+
+    The streams are split into partitions that share no state. Streams referring to each other
+    through an attribute, or through a list, tuple, set, deque or dict held in one, e.g. through
+    pipe() or a link like a dock deposit and its claim, always end up in the same partition.
+    Streams reached any other way, e.g. inside an object of another class, are not seen.
+    The only links that may cross partitions go from a stream with a lookahead (a Worker with
+    min_time_to_finish) into a stream that is always ready (an unbounded Queue or a Dropper).
+    Fully independent subnetworks need no links at all.
+
+    Each partition runs in its own process with its own event queue. Entities crossing a link
+    are sent as messages, and partitions are kept in step with the conservative null message
+    protocol: a partition only processes an event once no other partition can still send it
+    an entity that comes earlier. Lookahead lets a partition promise its neighbours how long
+    it will stay quiet, which is what keeps every partition moving.
+
+    The simulator needs a seed, so every stream draws the same substream wherever it runs.
+    With it, the entities match those of simulator.run(), and they are put in simulator.entity_list
+    in the same order and with the same ids, unless the simulator pools entities.
+    Each stream's partition_state() is copied back onto it, which by default covers counters
+    like dropped, and simulator.event_count is the total over partitions. Anything else a stream
+    holds, e.g. the entities waiting in a queue, stays in the worker process.
+    Randomness drawn outside of simulator.random_stream(), e.g. in an entity's __init__, will differ.
+    This relies on processes being forked, so it does not work on Windows.
+
+    Keyword Arguments:
+    processes -- The most processes to use. Defaults to the number of CPUs.
+    """
+    def __init__(self, simulator, *args, **kwargs):
+        self.simulator = simulator
+        self.processes = kwargs.get('processes', None) or multiprocessing.cpu_count()
+
+    def run(self):
+        simulator = self.simulator
+        if simulator.seed is None:
+            raise Exception("ParallelSimulator needs a simulator with a seed")
+        partitions, links = partition_streams(simulator, self.processes)
+        if len(partitions) < 2:
+            simulator.run()
+            return simulator.entity_list
+
+        inboxes = [multiprocessing.Queue() for partition in partitions]
+        results = multiprocessing.Queue()
+        processes = []
+        try:
+            for index in xrange(len(partitions)):
+                arguments = (simulator, partitions, links, index, inboxes, results)
+                process = multiprocessing.Process(target=_run_partition, args=arguments)
+                process.start()
+                processes.append(process)
+            # Results have to be read before joining, or large ones would block the pipe
+            collected = _collect(processes, results)
+            for process in processes:
+                process.join()
+        finally:
+            # After a failure the other partitions would wait for messages forever
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+
+        collected.sort(key=lambda result: result[0])
+        first_id = collected[0][1]
+        entities = []
+        simulator.event_count = 0
+        for index, start_id, partition_entities, states, event_count in collected:
+            entities.extend(partition_entities)
+            for stream, state in zip(partitions[index], states):
+                vars(stream).update(state)
+            simulator.event_count += event_count
+        simulator.current_time = simulator.time_limit
+        entities.sort(key=lambda entity: _creation_event(simulator, entity))
+        for offset, entity in enumerate(entities):
+            entity.id = first_id + offset
+            entity.stream_names = simulator.stream_names
+            entity.stream_ids = simulator.stream_ids
+        Entity.id = first_id + len(entities)
+        simulator.entity_list[:] = entities
+        return entities
+
+
+def check_against_sequential(create_simulator, processes=None):
+    """
+    Raises if ParallelSimulator gives different results than Simulator.run for a model.
+    create_simulator is called twice, and must return a fresh seeded simulator each time.
+    One is run sequentially and one in parallel, and their entities (ids and histories)
+    and the partition_state() of every stream are compared.
+    Run it on a small instance of a model before trusting parallel runs of it.
+    """
+    first_id = Entity.id
+    sequential = create_simulator()
+    sequential.run()
+    Entity.id = first_id
+    parallel = create_simulator()
+    ParallelSimulator(parallel, processes=processes).run()
+
+    if len(sequential.entity_list) != len(parallel.entity_list):
+        raise Exception("Sequential run has {} entities but parallel run has {}".format(
+            len(sequential.entity_list), len(parallel.entity_list)))
+    for expected, actual in zip(sequential.entity_list, parallel.entity_list):
+        if expected.id != actual.id or expected.event_list != actual.event_list:
+            raise Exception("Entity {} differs between sequential and parallel runs".format(
+                expected.id))
+    for name, stream in sequential.streams.items():
+        expected = stream.partition_state()
+        actual = parallel.streams[name].partition_state()
+        if sorted(expected) != sorted(actual) or \
+                not all(_same(expected[key], actual[key]) for key in expected):
+            raise Exception("Stream {} differs between sequential and parallel runs".format(name))
+    if sequential.event_count != parallel.event_count:
+        raise Exception("Sequential run processed {} events but parallel run {}".format(
+            sequential.event_count, parallel.event_count))
+
+
+def _same(expected, actual):
+    if isinstance(expected, numpy.ndarray) or isinstance(actual, numpy.ndarray):
+        return numpy.array_equal(expected, actual)
+    return expected == actual
+
+
+def _collect(processes, results):
+    collected = []
+    while len(collected) < len(processes):
+        try:
+            result = results.get(timeout=0.1)
+        except Empty:
+            if all(process.is_alive() for process in processes):
+                continue
+            # A partition that finished has already flushed its result, so give it a moment
+            try:
+                result = results.get(timeout=1.0)
+            except Empty:
+                raise Exception("A partition process died without a result")
+        if result[0] == 'error':
+            raise Exception("Partition {} failed:\n{}".format(result[1], result[2]))
+        collected.append(pickle.loads(result[2]))
+    return collected
+
+
+def partition_streams(simulator, processes):
+    """
+    Splits the streams of simulator into at most processes partitions.
+    Returns (partitions, links), where partitions is a list of lists of streams and
+    links is a list of (source, destination) pairs of streams in different partitions.
+    """
+    streams = _find_streams(simulator)
+    candidates = set()
+    for stream in streams:
+        destination = getattr(stream, 'destination', None)
+        lookahead = stream.lookahead()
+        if isinstance(destination, Stream) and lookahead is not None and lookahead > 0 \
+                and destination.always_ready():
+            candidates.add((id(stream), id(destination)))
+
+    parents = dict((id(stream), id(stream)) for stream in streams)
+
+    def find(key):
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    for stream in streams:
+        for attribute, other in _references(stream):
+            if attribute in ('destination', 'source', 'sources') and \
+                    ((id(stream), id(other)) in candidates or (id(other), id(stream)) in candidates):
+                continue
+            parents[find(id(stream))] = find(id(other))
+
+    components = {}
+    for stream in streams:
+        components.setdefault(find(id(stream)), []).append(stream)
+
+    # Largest components first, each into the partition with the fewest streams so far
+    partitions = [[] for x in xrange(min(processes, len(components)))]
+    for component in sorted(components.values(), key=len, reverse=True):
+        min(partitions, key=len).extend(component)
+
+    partition_of = {}
+    for index, partition in enumerate(partitions):
+        for stream in partition:
+            partition_of[id(stream)] = index
+    links = []
+    for stream in streams:
+        destination = getattr(stream, 'destination', None)
+        if (id(stream), id(destination)) in candidates and \
+                partition_of[id(stream)] != partition_of[id(destination)]:
+            links.append((stream, destination))
+    return partitions, links
+
+
+def _find_streams(simulator):
+    streams = []
+    seen = set()
+    pending = list(simulator.streams.values())
+    while len(pending) > 0:
+        stream = pending.pop()
+        if id(stream) in seen:
+            continue
+        seen.add(id(stream))
+        streams.append(stream)
+        pending.extend(other for attribute, other in _references(stream))
+    return streams
+
+
+def _references(stream):
+    for attribute, value in vars(stream).items():
+        if isinstance(value, dict):
+            values = list(value.keys()) + list(value.values())
+        else:
+            values = [value]
+        for value in values:
+            if isinstance(value, Stream):
+                yield attribute, value
+            elif isinstance(value, (list, tuple, set, frozenset, deque)):
+                for item in value:
+                    if isinstance(item, Stream):
+                        yield attribute, item
+
+
+def _creation_event(simulator, entity):
+    # Spawners record an exit when they create an entity, so the first event says when and where
+    stream = simulator.streams[simulator.stream_names[entity.codes[0] >> 2]]
+    return SimulatorEvent(stream, stream.priority, entity.times[0])
+
+
+class _Outbound(object):
+    """Stands in for the destination of a link in the partition that sends entities over it"""
+    def __init__(self, link, inbox, sent):
+        self.link = link
+        self.inbox = inbox
+        self.sent = sent
+
+    def enter(self, entity, time):
+        # Keeping the entity stops its id being reused by a new one
+        self.sent[id(entity)] = entity
+        self.inbox.put((self.link, time, entity))
+
+    def ready(self):
+        return True
+
+    def notify_ready(self, other, time):
+        pass
+
+    def notify_unready(self, other, time):
+        pass
+
+
+class _Inbound(object):
+    """
+    Delivers the entities of a link in the partition that receives them.
+    It copies the id and priority of the sending stream, so its events are ordered
+    exactly like the sending stream's events would be in a single simulator.
+    """
+    def __init__(self, source, destination):
+        self.id = source.id
+        self.name = source.name
+        self.priority = source.priority
+        self.destination = destination
+        self.pending = deque()
+        self.delivered = 0
+
+    def tick(self, time):
+        self.delivered += 1
+        self.destination.enter(self.pending.popleft(), time)
+
+
+def _run_partition(simulator, partitions, links, index, inboxes, results):
+    try:
+        result = _simulate_partition(simulator, partitions, links, index, inboxes)
+        # Pickled here, so a result that cannot be pickled is reported like any other error
+        results.put(('done', index, pickle.dumps(result, pickle.HIGHEST_PROTOCOL)))
+    except Exception:
+        results.put(('error', index, traceback.format_exc()))
+
+
+def _simulate_partition(simulator, partitions, links, index, inboxes):
+    own = set(id(stream) for stream in partitions[index])
+    partition_of = {}
+    for number, partition in enumerate(partitions):
+        for stream in partition:
+            partition_of[id(stream)] = number
+
+    simulator.reset()
+    start_id = Entity.id
+    simulator.start()
+    event_queue = simulator.event_queue
+    event_queue[:] = [event for event in event_queue if id(event.stream) in own]
+    heapq.heapify(event_queue)
+
+    sent = {}
+    received = []
+    outgoing = []
+    inbound = {}
+    clocks = {}
+    for link, (source, destination) in enumerate(links):
+        if id(source) in own:
+            source.destination = _Outbound(link, inboxes[partition_of[id(destination)]], sent)
+            outgoing.append([link, source, inboxes[partition_of[id(destination)]], -1.0])
+        if id(destination) in own:
+            inbound[link] = _Inbound(source, destination)
+            clocks[link] = SimulatorEvent(inbound[link], source.priority, 0.0)
+
+    inbox = inboxes[index]
+    time_limit = simulator.time_limit
+    infinity = float('inf')
+
+    def receive(message):
+        link, time, entity = message
+        proxy = inbound[link]
+        if entity is not None:
+            if simulator.entity_pool is None:
+                received.append(entity)
+            proxy.pending.append(entity)
+            simulator.tick_future(proxy, time)
+        # No later message on this link can come before this one
+        clocks[link] = SimulatorEvent(proxy, proxy.priority, time)
+
+    while True:
+        safe = min(clocks.values()) if len(clocks) > 0 else None
+        while len(event_queue) > 0 and event_queue[0].time <= time_limit and \
+                (safe is None or event_queue[0] < safe):
+            simulator.dispatch(heapq.heappop(event_queue))
+
+        lower = event_queue[0].time if len(event_queue) > 0 else infinity
+        if safe is not None:
+            lower = min(lower, safe.time)
+        if lower > time_limit:
+            for link, source, destination_inbox, promised in outgoing:
+                if promised < infinity:
+                    destination_inbox.put((link, infinity, None))
+            break
+
+        # Null messages: promise each neighbour the earliest time another entity could reach it.
+        # Past the time limit nothing more will be sent, so the neighbour is told it is done.
+        for out in outgoing:
+            link, source, destination_inbox, promised = out
+            bound = lower + source.lookahead()
+            pending = source.next_output_time()
+            if pending is not None:
+                bound = min(bound, pending)
+            if bound > time_limit:
+                bound = infinity
+            if bound > promised:
+                destination_inbox.put((link, bound, None))
+                out[3] = bound
+
+        receive(inbox.get())
+        while True:
+            try:
+                receive(inbox.get_nowait())
+            except Empty:
+                break
+
+    entities = [entity for entity in simulator.entity_list + received if id(entity) not in sent]
+    states = [stream.partition_state() for stream in partitions[index]]
+    # Deliveries are not events of the sequential engine
+    event_count = simulator.event_count - sum(proxy.delivered for proxy in inbound.values())
+    return index, start_id, entities, states, event_count
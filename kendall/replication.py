@@ -0,0 +1,55 @@
+import math
+
+
+def run_replications(create_simulator, measure, replications, seed=0, antithetic=False):
+    """
+    Runs independent replications and returns one measurement per replication.
+
+    create_simulator -- Called with no arguments, returns a fresh simulator.
+    measure -- Called with the simulator after each run, returns a number.
+    replications -- The number of measurements to return.
+    seed -- Replication i uses seed + i for all of its substreams.
+    antithetic -- If True, each measurement is the average of a run and its antithetic run.
+                  The pair averages are independent, so they can be treated like plain replications.
+    """
+    results = []
+    for replication in xrange(replications):
+        value = _run_once(create_simulator, measure, seed + replication, False)
+        if antithetic:
+            value = (value + _run_once(create_simulator, measure, seed + replication, True)) / 2.0
+        results.append(value)
+    return results
+
+
+def compare_scenarios(create_first, create_second, measure, replications, seed=0,
+                      common_random_numbers=True, antithetic=False):
+    """
+    Runs two scenarios side by side and returns the per-replication differences (first - second).
+
+    With common_random_numbers, replication i of both scenarios uses the same seed, so every
+    logical stream (a spawner's interarrivals, a worker's service times) sees the same draws
+    in both scenarios. The noise shared by the two runs then cancels out of the difference.
+    Without it, the second scenario uses seeds that do not overlap the first's.
+    """
+    second_seed = seed if common_random_numbers else seed + replications
+    first = run_replications(create_first, measure, replications, seed, antithetic)
+    second = run_replications(create_second, measure, replications, second_seed, antithetic)
+    return [a - b for a, b in zip(first, second)]
+
+
+def confidence_interval(samples, z=1.96):
+    """Returns (mean, half width) of the normal confidence interval for the mean of samples"""
+    n = len(samples)
+    mean = sum(samples) / float(n)
+    if n < 2:
+        return mean, float('inf')
+    variance = sum((x - mean) ** 2 for x in samples) / float(n - 1)
+    return mean, z * math.sqrt(variance / n)
+
+
+def _run_once(create_simulator, measure, seed, antithetic):
+    simulator = create_simulator()
+    simulator.seed = seed
+    simulator.antithetic = antithetic
+    simulator.run()
+    return measure(simulator)
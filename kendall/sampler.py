@@ -0,0 +1,99 @@
+import time as wallclock
+import numpy
+from .main import Stream
+
+
+def queue_length(queue):
+    return len(queue.queue)
+
+
+def busy_servers(worker):
+    return worker.current
+
+
+def dropped(stream):
+    return stream.dropped
+
+
+class Sampler(Stream):
+    """
+    A sampler records gauges of other streams every interval of simulated time.
+    Samples go into a preallocated ring buffer, so only the latest capacity samples are kept
+    and the cost of sampling depends on the number of samples, not the number of events.
+    It ticks with a low priority, so it sees the state after everything else at the same time.
+
+    Keyword Arguments:
+    gauges -- A list of (label, stream, function). Each sample stores function(stream),
+              e.g. ("Harbor queue", harbor_queue, queue_length).
+    interval -- Simulated time between samples.
+    capacity -- How many samples to keep.
+    progress -- If set, called as progress(simulated time, events per second, seconds left)
+                when progress_interval wall clock seconds have passed, checked at every sample.
+    progress_interval -- Wall clock seconds between progress calls.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('priority', 10**9)
+        super(Sampler, self).__init__(*args, **kwargs)
+        self.gauges = kwargs.get('gauges', [])
+        self.labels = [label for label, stream, function in self.gauges]
+        # Keeps the sampled streams in the sampler's partition when run by ParallelSimulator,
+        # and partition_state() sends the samples back from it
+        self.sampled_streams = [stream for label, stream, function in self.gauges]
+        self.interval = kwargs.get('interval', 1)
+        self.capacity = kwargs.get('capacity', 1000)
+        self.progress = kwargs.get('progress', None)
+        self.progress_interval = kwargs.get('progress_interval', 1.0)
+        self.buffer = numpy.zeros((self.capacity, len(self.gauges) + 1))
+        self.count = 0
+
+    def start(self):
+        self.count = 0
+        self.last_report = (wallclock.time(), 0.0, 0)
+        self.simulator.tick_future(self, 0.0)
+
+    def tick(self, time):
+        row = self.buffer[self.count % self.capacity]
+        row[0] = time
+        for column, (label, stream, function) in enumerate(self.gauges):
+            row[column + 1] = function(stream)
+        self.count += 1
+        if self.progress is not None:
+            self.report(time)
+        self.simulator.tick_future(self, time + self.interval)
+
+    def report(self, time):
+        now = wallclock.time()
+        last_wall, last_time, last_events = self.last_report
+        elapsed = now - last_wall
+        if elapsed < self.progress_interval:
+            return
+        events = self.simulator.event_count
+        events_per_second = (events - last_events) / elapsed
+        simulated_per_second = (time - last_time) / elapsed
+        if simulated_per_second > 0:
+            seconds_left = (self.simulator.time_limit - time) / simulated_per_second
+        else:
+            seconds_left = float('inf')
+        self.progress(time, events_per_second, seconds_left)
+        self.last_report = (now, time, events)
+
+    def partition_state(self):
+        state = super(Sampler, self).partition_state()
+        state['buffer'] = self.buffer
+        return state
+
+    def samples(self):
+        """Returns the kept samples, oldest first, one row per sample. Column 0 is the time."""
+        if self.count <= self.capacity:
+            return self.buffer[:self.count].copy()
+        return numpy.roll(self.buffer, -(self.count % self.capacity), axis=0)
+
+    def times(self):
+        return self.samples()[:, 0]
+
+    def gauge(self, label):
+        return self.samples()[:, self.labels.index(label) + 1]
+
+    def rate(self, label):
+        """The change per unit time of a counting gauge like dropped between samples"""
+        return numpy.diff(self.gauge(label)) / float(self.interval)
@@ -1,18 +1,26 @@
 from .main import Entity, SISOStream
-import numpy.random
 
 
 class Spawner(SISOStream):
     """This implements the generic class for a spawner.
     A spawner has the properties:
     name -- The name of this queue
+    entity_class -- The class of entities created, Entity by default
+    spawned -- The number of entities created so far this run
 
     Interesting things to override:
     next_event_time - Dictates the time between events
+    mean_spawn_time - The average time between events, used by the fluid approximation
+    scale_spawn_time - Stretches the time between events, used to scale a model down for calibrate
     create_entity - Dictates what entities are created
     """
+    def __init__(self, *args, **kwargs):
+        super(Spawner, self).__init__(*args, **kwargs)
+        self.entity_class = kwargs.get('entity_class', Entity)
+        self.spawned = 0
 
     def start(self):
+        self.spawned = 0
         first_event_time = self.next_event_time(0)
         self.simulator.tick_future(self, first_event_time)
 
@@ -22,19 +30,29 @@ class Spawner(SISOStream):
     def tick(self, time):
         entity = self.create_entity(time)
         self.simulator.add_entity(entity)
+        self.spawned += 1
         entity.on_exit(self, time)
         self.destination.enter(entity, time)
         next_spawn_time = self.next_event_time(time)
         self.simulator.tick_future(self, next_spawn_time)
 
-    def notify_ready(self, time):
+    def notify_ready(self, other, time):
         pass
 
     def next_event_time(self, time):
         raise Exception("Please implement this for the spawner")
 
+    def mean_spawn_time(self):
+        raise Exception("Please implement this for the spawner")
+
+    def scale_spawn_time(self, factor):
+        raise Exception("Please implement this for the spawner")
+
     def create_entity(self, time):
-        return Entity()
+        entity = self.simulator.reuse_entity(self.entity_class)
+        if entity is None:
+            entity = self.entity_class()
+        return entity
 
 
 class ConstantSpawner(Spawner):
@@ -49,6 +67,12 @@ class ConstantSpawner(Spawner):
     def next_event_time(self, time):
         return time + self.spawn_time
 
+    def mean_spawn_time(self):
+        return self.spawn_time
+
+    def scale_spawn_time(self, factor):
+        self.spawn_time *= factor
+
 
 class UniformSpawner(Spawner):
     def __init__(self, *args, **kwargs):
@@ -61,7 +85,14 @@ class UniformSpawner(Spawner):
         self.high = kwargs.get('high', 1)
 
     def next_event_time(self, time):
-        return time + numpy.random.uniform(self.low, self.high)
+        return time + self.simulator.random_stream(self).uniform(self.low, self.high)
+
+    def mean_spawn_time(self):
+        return (self.low + self.high) / 2.0
+
+    def scale_spawn_time(self, factor):
+        self.low *= factor
+        self.high *= factor
 
 
 class ExponentialSpawner(Spawner):
@@ -74,4 +105,10 @@ class ExponentialSpawner(Spawner):
         self.spawn_time = kwargs.get('spawn_time', 1)
 
     def next_event_time(self, time):
-        return time + numpy.random.exponential(self.spawn_time)
+        return time + self.simulator.random_stream(self).exponential(self.spawn_time)
+
+    def mean_spawn_time(self):
+        return self.spawn_time
+
+    def scale_spawn_time(self, factor):
+        self.spawn_time *= factor
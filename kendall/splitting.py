@@ -0,0 +1,174 @@
+import math
+
+
+class SplittingEstimate(object):
+    """
+    The result of fixed_effort_splitting.
+    level_probabilities -- The fraction of trials at each stage that reached the next level.
+    estimate -- The probability of reaching the last level, the product of the above.
+    relative_error -- The standard error of the estimate divided by the estimate.
+                      It treats the stages as independent, so it is a little optimistic.
+    """
+    def __init__(self, level_probabilities, effort):
+        self.level_probabilities = level_probabilities
+        self.effort = effort
+        self.estimate = 1.0
+        for probability in level_probabilities:
+            self.estimate *= probability
+        if self.estimate > 0:
+            self.relative_error = math.sqrt(sum((1.0 - p) / (p * effort)
+                                                for p in level_probabilities))
+        else:
+            self.relative_error = float('inf')
+
+
+class BlockingEstimate(object):
+    """
+    The result of blocking_probability.
+    hitting -- The SplittingEstimate for reaching the last level.
+    mean_drops -- The average drops up to the time limit of trials continued from the last level.
+    mean_arrivals -- The average arrivals up to the time limit of a whole run.
+    estimate -- The fraction of arrivals that are dropped,
+                hitting.estimate * mean_drops / mean_arrivals.
+    relative_error -- The standard error of the estimate divided by the estimate,
+                      combining the three parts as if they were independent.
+    """
+    def __init__(self, hitting, drops, arrivals):
+        self.hitting = hitting
+        self.mean_drops, drops_error = _mean_and_relative_error(drops)
+        self.mean_arrivals, arrivals_error = _mean_and_relative_error(arrivals)
+        if self.mean_arrivals > 0:
+            self.estimate = hitting.estimate * self.mean_drops / self.mean_arrivals
+        else:
+            self.estimate = 0.0
+        if self.estimate > 0:
+            self.relative_error = math.sqrt(hitting.relative_error ** 2 + drops_error ** 2
+                                            + arrivals_error ** 2)
+        else:
+            self.relative_error = float('inf')
+
+
+def fixed_effort_splitting(simulator, importance, levels, effort, seed=None):
+    """
+    Estimates the probability that importance(simulator) reaches levels[-1] at some point
+    before the time limit, using fixed-effort multilevel splitting.
+    This is a hitting probability. For the fraction of arrivals a loss system blocks,
+    use blocking_probability.
+
+    Stage 0 runs effort trials from the start of the simulation and clones the simulator whenever
+    a trial reaches levels[0]. Each later stage starts effort trials from those clones, spread
+    evenly over them, and keeps the clones that reach the next level. The final estimate is
+    the product of the fraction of successful trials at each stage.
+
+    simulator -- The simulator to estimate with. It is reset for every stage 0 trial,
+                 and its seed is restored afterwards.
+    importance -- Called with the simulator after every event, returns a number.
+                  Look streams up through the simulator it is given, since clones have their own:
+                  e.g. lambda simulator: simulator.streams["Lines"].current for busy lines.
+    levels -- Increasing thresholds of importance. The last one is the rare event.
+    effort -- The number of trials per stage.
+    seed -- Every trial gets its own seed starting from this one. Defaults to simulator.seed.
+            If neither is set, all trials share the global numpy.random state.
+    """
+    original_seed = simulator.seed
+    try:
+        probabilities, states, next_seed = _split(simulator, importance, levels, effort, seed)
+    finally:
+        simulator.seed = original_seed
+    return SplittingEstimate(probabilities, effort)
+
+
+def blocking_probability(simulator, importance, levels, effort, drops, arrivals, seed=None):
+    """
+    Estimates the fraction of arrivals that are dropped up to the time limit,
+    e.g. the blocking probability of a TelephoneSystem with max_queued=0.
+
+    Drops can only happen once importance reaches levels[-1], e.g. when every line is busy,
+    so the expected number of drops is the probability of getting there times the expected
+    drops afterwards. The first comes from fixed_effort_splitting. For the second, effort
+    trials continue from the clones that reached the last level up to the time limit.
+    The stage 0 trials also run to the time limit, to count the expected number of arrivals.
+
+    drops -- Called with the simulator, returns the number of entities dropped so far,
+             e.g. lambda simulator: simulator.streams["Lines"].dropped
+    arrivals -- Called with the simulator, returns the number of entities spawned so far,
+                e.g. lambda simulator: simulator.streams["Calls"].spawned
+    The other arguments are as for fixed_effort_splitting.
+    """
+    original_seed = simulator.seed
+    arrival_counts = []
+    try:
+        probabilities, states, next_seed = _split(simulator, importance, levels, effort, seed,
+                                                  arrivals, arrival_counts)
+    finally:
+        simulator.seed = original_seed
+
+    drop_counts = []
+    if len(states) > 0:
+        for trial in xrange(effort):
+            state = states[trial % len(states)].clone()
+            if next_seed is not None:
+                state.reseed(next_seed)
+                next_seed += 1
+            before = drops(state)
+            state.advance()
+            drop_counts.append(drops(state) - before)
+    else:
+        drop_counts.append(0)
+    return BlockingEstimate(SplittingEstimate(probabilities, effort), drop_counts, arrival_counts)
+
+
+def _split(simulator, importance, levels, effort, seed, arrivals=None, arrival_counts=None):
+    """
+    Runs the splitting stages. Returns the level probabilities, the clones that reached
+    the last level and the next unused seed. If arrivals is given, stage 0 trials run on
+    to the time limit and append arrivals(simulator) to arrival_counts.
+    """
+    if seed is None:
+        # A seeded simulator would otherwise replay the same draws in every trial
+        seed = simulator.seed
+    probabilities = []
+    states = []
+    for trial in xrange(effort):
+        if seed is not None:
+            simulator.seed = seed + trial
+        simulator.reset()
+        simulator.start()
+        if _advance_to(simulator, importance, levels[0]):
+            states.append(simulator.clone())
+        if arrivals is not None:
+            simulator.advance()
+            arrival_counts.append(arrivals(simulator))
+    probabilities.append(len(states) / float(effort))
+
+    next_seed = None if seed is None else seed + effort
+    for level in levels[1:]:
+        if len(states) == 0:
+            probabilities.append(0.0)
+            continue
+        hits = []
+        for trial in xrange(effort):
+            state = states[trial % len(states)].clone()
+            if next_seed is not None:
+                state.reseed(next_seed)
+                next_seed += 1
+            if _advance_to(state, importance, level):
+                hits.append(state)
+        probabilities.append(len(hits) / float(effort))
+        states = hits
+    return probabilities, states, next_seed
+
+
+def _advance_to(simulator, importance, level):
+    if importance(simulator) >= level:
+        return True
+    return simulator.advance(stop=lambda s: importance(s) >= level)
+
+
+def _mean_and_relative_error(samples):
+    n = len(samples)
+    mean = sum(samples) / float(n)
+    if mean == 0 or n < 2:
+        return mean, 0.0
+    variance = sum((x - mean) ** 2 for x in samples) / float(n - 1)
+    return mean, math.sqrt(variance / n) / mean
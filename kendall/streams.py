@@ -1,4 +1,3 @@
-import random
 from collections import deque
 from .main import SingleInputStream, SingleOutputStream, SISOStream
 
@@ -10,6 +9,7 @@ class Queue(SISOStream):
     name -- The name of this queue
     queue -- The currently queued items
     max_queued -- The limit on the queue before it starts dropping events
+    dropped -- The number of entities dropped so far this run
 
     Override enqueue/dequeue to change the FIFO-ness on events.
     """
@@ -18,8 +18,10 @@ class Queue(SISOStream):
         super(Queue, self).__init__(*args, **kwargs)
         self.queue = deque()
         self.max_queued = kwargs.get('max_queued', 10**100)
+        self.dropped = 0
 
     def start(self):
+        self.dropped = 0
         while len(self.queue) > 0:
             self.queue.pop()
 
@@ -40,6 +42,8 @@ class Queue(SISOStream):
         else:
             entity.on_enter(self, time)
             entity.on_drop(self, time)
+            self.dropped += 1
+            self.simulator.release_entity(entity)
 
     def is_full(self):
         return len(self.queue) >= self.max_queued
@@ -47,6 +51,9 @@ class Queue(SISOStream):
     def ready(self):
         return not self.is_full() or self.destination.ready()
 
+    def always_ready(self):
+        return self.max_queued >= 10**100
+
     def notify_ready(self, other, time):
         was_full = self.is_full()
         if len(self.queue) > 0:
@@ -63,20 +70,36 @@ class Worker(SISOStream):
     This is a simple worker.
     A worker has the following properties:
     capacity - How many workers it can work on at the same time
+    min_time_to_finish - A lower bound on time_to_finish, if known. Used as the lookahead.
+    mean_time_to_finish - The average of time_to_finish. Needed by the fluid approximation
+                          if time_to_finish is overridden.
+    dropped - The number of entities dropped so far this run
 
     Interesting things to override:
-    time_to_finish - Dictates the time to work on an entity
+    time_to_finish - Dictates the time to work on an entity.
+                     Draw from self.simulator.random_stream(self) to get common random numbers.
     """
     def __init__(self, *args, **kwargs):
         super(Worker, self).__init__(*args, **kwargs)
         self.entities = {}
         self.current = 0
         self.capacity = kwargs.get('capacity', 1)
+        self.min_time_to_finish = kwargs.get('min_time_to_finish', None)
+        self.mean_time_to_finish = kwargs.get('mean_time_to_finish', None)
         self.completed = deque()
+        self.dropped = 0
 
     def time_to_finish(self, entity, time):
         return 1
 
+    def lookahead(self):
+        return self.min_time_to_finish
+
+    def next_output_time(self):
+        if len(self.entities) > 0:
+            return min(self.entities)
+        return None
+
     def push_completed(self, time):
         was_full = self.current == self.capacity
         if self.destination.ready() and len(self.completed) > 0:
@@ -89,12 +112,18 @@ class Worker(SISOStream):
 
     def start(self):
         self.current = 0
+        self.dropped = 0
         self.entities.clear()
+        self.completed.clear()
 
     def enter(self, entity, time):
         if self.current < self.capacity:
             entity.on_enter(self, time)
-            later = time + self.time_to_finish(entity, time)
+            duration = self.time_to_finish(entity, time)
+            if self.min_time_to_finish is not None and duration < self.min_time_to_finish:
+                raise Exception("Worker {} took {} but its min_time_to_finish is {}".format(
+                    self.name, duration, self.min_time_to_finish))
+            later = time + duration
             if self.entities.get(later) is None:
                 self.entities[later] = deque()
             self.current += 1
@@ -105,9 +134,11 @@ class Worker(SISOStream):
         else:
             entity.on_enter(self, time)
             entity.on_drop(self, time)
+            self.dropped += 1
+            self.simulator.release_entity(entity)
 
     def ready(self):
-        return self.current <= self.capacity
+        return self.current < self.capacity
 
     def tick(self, time):
         entity = self.entities[time].popleft()
@@ -126,16 +157,19 @@ class Splitter(SingleInputStream):
     A splitter has the properties:
     destinations -- The destinations of this stream
     ready_destinations -- The ist of destinations which are ready
+    dropped -- The number of entities dropped so far this run
     """
     def __init__(self, *args, **kwargs):
         super(Splitter, self).__init__(*args, **kwargs)
         self.destinations = []
         self.ready_destinations = deque()
+        self.dropped = 0
 
     def select_destination(self, entity, time):
         return self.ready_destinations[0]
 
     def start(self):
+        self.dropped = 0
         while len(self.ready_destinations) > 0:
             self.ready_destinations.pop()
         for destination in self.destinations:
@@ -155,6 +189,8 @@ class Splitter(SingleInputStream):
         else:
             entity.on_enter(self, time)
             entity.on_drop(self, time)
+            self.dropped += 1
+            self.simulator.release_entity(entity)
 
     def ready(self):
         if len(self.ready_destinations) > 0:
@@ -175,7 +211,7 @@ class Splitter(SingleInputStream):
 
 class RandomSplitter(Splitter):
     def select_destination(self, entity, time):
-        return random.choice(self.ready_destinations)
+        return self.simulator.random_stream(self).choice(self.ready_destinations)
 
 
 class Merger(SingleOutputStream):
@@ -212,6 +248,13 @@ class Merger(SingleOutputStream):
 
 
 class Dropper(SISOStream):
+    def __init__(self, *args, **kwargs):
+        super(Dropper, self).__init__(*args, **kwargs)
+        self.dropped = 0
+
+    def start(self):
+        self.dropped = 0
+
     def enter(self, entity, time):
         if self.destination is not None and self.destination.ready():
             entity.on_enter(self, time)
@@ -220,6 +263,8 @@ class Dropper(SISOStream):
         else:
             entity.on_enter(self, time)
             entity.on_drop(self, time)
+            self.dropped += 1
+            self.simulator.release_entity(entity)
 
     def ready(self):
         return True
@@ -229,3 +274,6 @@ class Dropper(SISOStream):
 
     def notify_unready(self, other, time):
         pass
+
+    def always_ready(self):
+        return True